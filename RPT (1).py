@@ -4,10 +4,27 @@ import pandas as pd
 import re
 import io
 import traceback
+import os
+import sys
 import json
+import time
+import hashlib
+import threading
+import mmap
+import shutil
+import tempfile
+import zipfile
+import unicodedata
+import xlsxwriter
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pdfminer.pdftypes import resolve1, PDFObjRef, PDFStream
 from pathlib import Path
+from contextlib import contextmanager
 from PIL import Image
 from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
 from google.oauth2.service_account import Credentials
@@ -27,12 +44,31 @@ for key, val in {
     'archivos_procesados': None,
     'comparacion_ejecutada': False,
     'dataframes_procesados': None,
+    'comparaciones_procesadas': None,
     'info_archivos': None,
     'revision_activa': None,
+    'exportacion': None,
+    'indice_ocupantes': None,
+    'trabajo_activo': None,
+    'cubo_agregados': None,
 }.items():
     if key not in st.session_state:
         st.session_state[key] = val
 
+def reiniciar_sesion():
+    """Vuelve al estado inicial de la pantalla de carga."""
+    borrar_exportacion(st.session_state.exportacion)
+    st.session_state.archivos_procesados = None
+    st.session_state.comparacion_ejecutada = False
+    st.session_state.dataframes_procesados = None
+    st.session_state.comparaciones_procesadas = None
+    st.session_state.info_archivos = None
+    st.session_state.revision_activa = None
+    st.session_state.exportacion = None
+    st.session_state.indice_ocupantes = None
+    st.session_state.trabajo_activo = None
+    st.session_state.cubo_agregados = None
+
 try:
     icono_pestana = Image.open(ICONO_FILE)
 except Exception:
@@ -148,13 +184,13 @@ def listar_revisiones(service, carpeta_raiz_id):
 def listar_pdfs_revision(service, carpeta_id):
     """Lista los PDFs dentro de una carpeta de revisión."""
     query = f"'{carpeta_id}' in parents and mimeType='application/pdf' and trashed=false"
-    results = service.files().list(q=query, fields="files(id, name)").execute()
+    results = service.files().list(q=query, fields="files(id, name, md5Checksum)").execute()
     return results.get("files", [])
 
-def subir_pdf_drive(service, nombre_archivo, bytes_pdf, carpeta_id):
-    """Sube un PDF a Google Drive en la carpeta indicada."""
+def subir_pdf_drive(service, nombre_archivo, archivo, carpeta_id):
+    """Sube un PDF (objeto tipo archivo) a Google Drive en la carpeta indicada."""
     metadata = {"name": nombre_archivo, "parents": [carpeta_id]}
-    media = MediaIoBaseUpload(io.BytesIO(bytes_pdf), mimetype="application/pdf")
+    media = MediaIoBaseUpload(archivo, mimetype="application/pdf")
     service.files().create(body=metadata, media_body=media, fields="id").execute()
 
 def descargar_pdf_drive(service, file_id):
@@ -171,6 +207,79 @@ def eliminar_carpeta_drive(service, carpeta_id):
     """Elimina una carpeta y su contenido de Google Drive."""
     service.files().delete(fileId=carpeta_id).execute()
 
+# ============================================================================
+# ALMACÉN TEMPORAL DE PDFs (direccionado por contenido)
+# ============================================================================
+DIR_ALMACEN_PDF = Path(tempfile.gettempdir()) / "rpt_pdfs"
+SEGUNDOS_INACTIVIDAD_PDF = 6 * 3600
+SEGUNDOS_ENTRE_LIMPIEZAS = 10 * 60
+
+def ruta_pdf_almacen(huella):
+    return DIR_ALMACEN_PDF / f"{huella}.pdf"
+
+def guardar_pdf_almacen(archivo_bytes):
+    """Escribe el PDF en disco una sola vez por contenido y devuelve su huella.
+
+    En session_state solo se guarda la huella; los bytes se vuelven a leer
+    del almacén (con mmap) cuando hace falta procesarlos. Un archivo vacío
+    no se puede mapear en memoria, así que se rechaza con ValueError.
+    """
+    if not archivo_bytes:
+        raise ValueError("el archivo está vacío")
+    huella = hashlib.sha256(archivo_bytes).hexdigest()
+    ruta = ruta_pdf_almacen(huella)
+    if ruta.exists():
+        os.utime(ruta)
+        return huella
+    DIR_ALMACEN_PDF.mkdir(parents=True, exist_ok=True)
+    # Escritura atómica: otra sesión puede estar guardando el mismo PDF
+    ruta_tmp = ruta.with_name(f"{huella}.{os.getpid()}.{threading.get_ident()}.tmp")
+    ruta_tmp.write_bytes(archivo_bytes)
+    os.replace(ruta_tmp, ruta)
+    return huella
+
+@contextmanager
+def abrir_pdf_almacen(huella):
+    """Abre un PDF del almacén como mapa de memoria de solo lectura.
+
+    Lanza FileNotFoundError si la entrada ya se ha borrado por inactividad.
+    """
+    ruta = ruta_pdf_almacen(huella)
+    os.utime(ruta)
+    with open(ruta, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as datos:
+        yield datos
+
+@st.cache_resource
+def obtener_estado_limpieza():
+    return {'lock': threading.Lock(), 'ultima': 0.0}
+
+def limpiar_almacen_pdf():
+    """Borra los PDFs del almacén y las exportaciones que llevan
+    SEGUNDOS_INACTIVIDAD_PDF sin usarse.
+
+    Las exportaciones de sesiones que se cierran sin reiniciar quedarían
+    en disco para siempre si no se barrieran aquí. Como mucho se recorren
+    los directorios una vez cada SEGUNDOS_ENTRE_LIMPIEZAS para todo el servidor.
+    """
+    estado = obtener_estado_limpieza()
+    ahora = time.time()
+    with estado['lock']:
+        if ahora - estado['ultima'] < SEGUNDOS_ENTRE_LIMPIEZAS:
+            return
+        estado['ultima'] = ahora
+    for directorio in (DIR_ALMACEN_PDF, DIR_EXPORTACIONES):
+        if not directorio.exists():
+            continue
+        for ruta in directorio.iterdir():
+            try:
+                if ahora - ruta.stat().st_mtime > SEGUNDOS_INACTIVIDAD_PDF:
+                    if ruta.is_dir():
+                        shutil.rmtree(ruta, ignore_errors=True)
+                    else:
+                        ruta.unlink()
+            except OSError:
+                pass
+
 # ============================================================================
 # FUNCIONES DE EXTRACCIÓN (igual que antes)
 # ============================================================================
@@ -249,9 +358,9 @@ def extraer_dotacion(linea):
     if len(partes) > 2 and (partes[-1] == 'N' or partes[-2] == 'N'): return "NO DOTADA"
     return "DOTADA"
 
-def extraer_fecha_pdf(archivo_bytes, nombre_archivo):
+def extraer_fecha_pdf(archivo, nombre_archivo):
     try:
-        with pdfplumber.open(io.BytesIO(archivo_bytes)) as pdf:
+        with pdfplumber.open(archivo) as pdf:
             if pdf.pages:
                 texto = pdf.pages[0].extract_text()
                 if texto:
@@ -264,72 +373,166 @@ def extraer_fecha_pdf(archivo_bytes, nombre_archivo):
         pass
     return None
 
-def procesar_pdf(archivo_bytes, nombre_archivo):
+# ============================================================================
+# DEDUPLICACIÓN DE PÁGINAS ENTRE VERSIONES
+# ============================================================================
+# Las líneas extraídas de cada página se guardan en la caché compartida
+# (obtener_cache_versiones) con clave ('pagina', huella), dentro de su
+# presupuesto de memoria. Los registros no se cachean: parsear_lineas es
+# barato comparado con extract_text.
+LINEAS_ADYACENTES = 5
+
+def actualizar_huella(h, obj, memo):
+    """Añade al hash un objeto PDF completo: diccionarios y listas de forma
+    recursiva y los streams por su contenido decodificado.
+
+    Los objetos indirectos se resumen una sola vez por documento en `memo`
+    (objid -> digest), lo que también corta las referencias circulares.
+    """
+    if isinstance(obj, PDFObjRef):
+        digest = memo.get(obj.objid)
+        if digest is None:
+            memo[obj.objid] = b'<ciclo>'
+            sub = hashlib.sha1()
+            actualizar_huella(sub, obj.resolve(), memo)
+            digest = memo[obj.objid] = sub.digest()
+        h.update(digest)
+    elif isinstance(obj, PDFStream):
+        actualizar_huella(h, obj.attrs, memo)
+        h.update(obj.get_data())
+    elif isinstance(obj, dict):
+        h.update(b'{')
+        for clave in sorted(obj, key=str):
+            h.update(str(clave).encode())
+            actualizar_huella(h, obj[clave], memo)
+        h.update(b'}')
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'[')
+        for elemento in obj:
+            actualizar_huella(h, elemento, memo)
+        h.update(b']')
+    else:
+        h.update(repr(obj).encode())
+
+def huella_pagina(pagina, memo):
+    """Hash del contenido bruto de una página: content streams, tamaño y recursos.
+
+    Los recursos se recorren enteros: fuentes con su ToUnicode, Encoding y
+    FontFile*, y XObjects (formularios con sus propios recursos), porque el
+    mismo content stream puede dar otro texto con otra fuente o dibujar el
+    texto dentro de un `/Fm1 Do`. Dos páginas con la misma huella producen
+    el mismo texto, así que las líneas extraídas de una versión anterior se
+    pueden reutilizar tal cual. `memo` es propio de cada documento.
+    Devuelve None si la página no se puede leer (entonces no se cachea).
+    """
+    try:
+        h = hashlib.sha1()
+        h.update(repr((pagina.width, pagina.height)).encode())
+        for flujo in pagina.page_obj.contents:
+            h.update(resolve1(flujo).get_data())
+        actualizar_huella(h, pagina.page_obj.resources or {}, memo)
+        return h.hexdigest()
+    except Exception:
+        return None
+
+def parsear_lineas(lineas, num_propias):
+    """Extrae las plazas que empiezan en las primeras `num_propias` líneas.
+
+    Las líneas restantes solo se usan para buscar el ocupante de las últimas
+    plazas de la página (hasta LINEAS_ADYACENTES líneas más allá).
+    """
+    registros = []
+    for i in range(num_propias):
+        linea = lineas[i]
+        if not es_linea_plaza(linea):
+            continue
+        codigo = extraer_codigo_puesto(linea)
+        if not codigo:
+            continue
+
+        nombre_ocupante = None
+        dni_ocupante = None
+        formacion_ocupante = None
+        lineas_adyacentes = []
+
+        for j in range(1, LINEAS_ADYACENTES + 1):
+            if (i + j) < len(lineas):
+                sig = lineas[i + j]
+                lineas_adyacentes.append(sig)
+                if es_linea_persona(sig):
+                    nombre_ocupante = extraer_nombre_persona(sig)
+                    dni_ocupante = extraer_dni(sig)
+                    formacion_ocupante = extraer_formacion(sig)
+                    break
+                if es_linea_plaza(sig): break
+
+        registros.append({
+            'Código':       codigo,
+            'Denominación': extraer_denominacion(linea),
+            'Grupo':        extraer_grupo(linea),
+            'Cuerpo':       extraer_cuerpo(linea),
+            'Provincia':    extraer_provincia(linea, lineas_adyacentes),
+            'Dotación':     extraer_dotacion(linea),
+            'Ocupante':     nombre_ocupante if nombre_ocupante else 'VACANTE',
+            'Estado_Plaza': 'OCUPADA' if nombre_ocupante else 'LIBRE',
+            'DNI':          dni_ocupante,
+            'Formacion':    formacion_ocupante
+        })
+    return registros
+
+def procesar_pdf(archivo, nombre_archivo, cache_versiones, avisos):
+    """Extrae las plazas de un PDF. No usa `st`: los mensajes van a `avisos`
+    como tuplas (tipo, texto, detalle) para poder ejecutarse en segundo plano.
+    Las páginas ya vistas en cualquier versión reutilizan sus líneas de
+    `cache_versiones` en lugar de pasar por extract_text."""
     registros = []
     try:
-        buffer = io.BytesIO(archivo_bytes)
-        with pdfplumber.open(buffer) as pdf:
+        with pdfplumber.open(archivo) as pdf:
             num_paginas = len(pdf.pages)
-            todas_lineas = []
+            lineas_por_pagina = []
             paginas_sin_texto = []
-
-            with st.spinner(f'📄 Procesando {nombre_archivo} ({num_paginas} páginas)...'):
-                for num_pag, pagina in enumerate(pdf.pages, 1):
+            paginas_reutilizadas = 0
+            memo_huellas = {}
+
+            for num_pag, pagina in enumerate(pdf.pages, 1):
+                huella = huella_pagina(pagina, memo_huellas)
+                lineas = cache_lru_obtener(cache_versiones, ('pagina', huella)) if huella else None
+                if lineas is not None:
+                    paginas_reutilizadas += 1
+                    if not lineas:
+                        paginas_sin_texto.append(num_pag)
+                else:
+                    lineas = []
                     try:
                         texto = pagina.extract_text()
                         if texto:
-                            todas_lineas.extend(texto.split('\n'))
+                            lineas = texto.split('\n')
                         else:
                             paginas_sin_texto.append(num_pag)
+                        if huella:
+                            cache_lru_guardar(cache_versiones, ('pagina', huella), lineas)
                     except Exception:
                         pass
-
-                if paginas_sin_texto:
-                    st.warning(f"⚠️ {len(paginas_sin_texto)} páginas sin texto en {nombre_archivo}")
-                st.info(f"✅ {nombre_archivo}: {len(todas_lineas):,} líneas extraídas de {num_paginas} páginas")
-
-            i = 0
-            while i < len(todas_lineas):
-                linea = todas_lineas[i]
-                if es_linea_plaza(linea):
-                    codigo = extraer_codigo_puesto(linea)
-                    if not codigo:
-                        i += 1
-                        continue
-
-                    nombre_ocupante = None
-                    dni_ocupante = None
-                    formacion_ocupante = None
-                    lineas_adyacentes = []
-
-                    for j in range(1, 6):
-                        if (i + j) < len(todas_lineas):
-                            sig = todas_lineas[i + j]
-                            lineas_adyacentes.append(sig)
-                            if es_linea_persona(sig):
-                                nombre_ocupante = extraer_nombre_persona(sig)
-                                dni_ocupante = extraer_dni(sig)
-                                formacion_ocupante = extraer_formacion(sig)
-                                break
-                            if es_linea_plaza(sig): break
-
-                    registros.append({
-                        'Código':       codigo,
-                        'Denominación': extraer_denominacion(linea),
-                        'Grupo':        extraer_grupo(linea),
-                        'Cuerpo':       extraer_cuerpo(linea),
-                        'Provincia':    extraer_provincia(linea, lineas_adyacentes),
-                        'Dotación':     extraer_dotacion(linea),
-                        'Ocupante':     nombre_ocupante if nombre_ocupante else 'VACANTE',
-                        'Estado_Plaza': 'OCUPADA' if nombre_ocupante else 'LIBRE',
-                        'DNI':          dni_ocupante,
-                        'Formacion':    formacion_ocupante
-                    })
-                i += 1
+                lineas_por_pagina.append(lineas)
+
+            total_lineas = sum(len(lineas) for lineas in lineas_por_pagina)
+            if paginas_sin_texto:
+                avisos.append(('warning', f"⚠️ {len(paginas_sin_texto)} páginas sin texto en {nombre_archivo}", None))
+            avisos.append(('info', f"✅ {nombre_archivo}: {total_lineas:,} líneas extraídas de {num_paginas} páginas"
+                                   f" ({paginas_reutilizadas} reutilizadas de versiones anteriores)", None))
+
+            for p, lineas in enumerate(lineas_por_pagina):
+                # Las plazas del final de la página buscan su ocupante en las siguientes
+                siguientes = []
+                for lineas_sig in lineas_por_pagina[p + 1:]:
+                    siguientes.extend(lineas_sig[:LINEAS_ADYACENTES - len(siguientes)])
+                    if len(siguientes) >= LINEAS_ADYACENTES:
+                        break
+                registros.extend(parsear_lineas(lineas + siguientes, len(lineas)))
 
         df_resultado = pd.DataFrame(registros)
         if df_resultado.empty:
-            st.error(f"❌ {nombre_archivo}: no se extrajeron plazas.")
+            avisos.append(('error', f"❌ {nombre_archivo}: no se extrajeron plazas.", None))
             return pd.DataFrame()
 
         # Gestión provisional/definitivo
@@ -349,35 +552,681 @@ def procesar_pdf(archivo_bytes, nombre_archivo):
                             df_resultado.loc[df_resultado['Código'] == codigo, 'Ocupante'] = f'({nombre_func})'
 
         df_resultado = df_resultado.drop_duplicates(subset=['Código'])
-        st.success(f"✅ {nombre_archivo}: {len(df_resultado):,} plazas únicas procesadas")
+        avisos.append(('success', f"✅ {nombre_archivo}: {len(df_resultado):,} plazas únicas procesadas", None))
         return df_resultado
 
     except Exception as e:
         tb = traceback.format_exc()
-        st.error(f"❌ Error procesando {nombre_archivo}: {e}")
-        with st.expander("🔍 Ver detalles técnicos"):
-            st.code(tb)
+        avisos.append(('error', f"❌ Error procesando {nombre_archivo}: {e}", tb))
         return pd.DataFrame()
 
-def ordenar_archivos_por_fecha(archivos_lista):
+def ordenar_archivos_por_fecha(archivos_lista, cache_versiones):
+    """Recibe (nombre, huella) y devuelve (nombre, huella, fecha) en orden cronológico.
+
+    La fecha de cada PDF se guarda en `cache_versiones` con clave
+    ('fecha', huella) ("" si no tiene), así una revisión ya procesada no
+    vuelve a abrir ningún PDF del almacén.
+    """
     archivos_con_fecha = []
-    for nombre, archivo_bytes in archivos_lista:
-        fecha_str = extraer_fecha_pdf(archivo_bytes, nombre)
+    for nombre, huella in archivos_lista:
+        fecha_str = cache_lru_obtener(cache_versiones, ('fecha', huella))
+        if fecha_str is None:
+            try:
+                with abrir_pdf_almacen(huella) as datos:
+                    fecha_str = extraer_fecha_pdf(datos, nombre)
+                cache_lru_guardar(cache_versiones, ('fecha', huella), fecha_str or "")
+            except (FileNotFoundError, ValueError):
+                fecha_str = None
         if fecha_str:
             try:
                 fecha_obj = datetime.strptime(fecha_str, '%d/%m/%Y')
-                archivos_con_fecha.append((nombre, archivo_bytes, fecha_obj, fecha_str))
+                archivos_con_fecha.append((nombre, huella, fecha_obj, fecha_str))
             except ValueError:
-                archivos_con_fecha.append((nombre, archivo_bytes, datetime.min, fecha_str))
+                archivos_con_fecha.append((nombre, huella, datetime.min, fecha_str))
         else:
-            archivos_con_fecha.append((nombre, archivo_bytes, datetime.min, "Sin fecha"))
+            archivos_con_fecha.append((nombre, huella, datetime.min, "Sin fecha"))
     archivos_con_fecha.sort(key=lambda x: x[2])
     return [(n, b, f) for n, b, _, f in archivos_con_fecha]
 
+# ============================================================================
+# FUNCIONES DE COMPARACIÓN
+# ============================================================================
+SITUACIONES_CAMBIO = [
+    '🆕 NUEVA',
+    '❌ ELIMINADA',
+    '🔄 CAMBIO OCUPANTE',
+    '💰 CAMBIO DOTACIÓN',
+    '🔄 CAMBIO OCUPANTE + DOTACIÓN',
+]
+
+COLS_VERSION = ['Código', 'Denominación', 'Grupo', 'Cuerpo', 'Provincia', 'Dotación', 'Estado_Plaza', 'Ocupante', 'DNI', 'Formacion']
+
+COLS_COMPARACION = [
+    'Código', 'Denominación', 'Grupo', 'Cuerpo', 'Provincia', 'Situación',
+    'Dotación Anterior', 'Dotación Actual', 'Estado',
+    'Ocupante Anterior', 'Ocupante Actual'
+]
+
+def det_estado_comp(row):
+    if row['_merge'] == 'left_only':  return '❌ ELIMINADA'
+    if row['_merge'] == 'right_only': return '🆕 NUEVA'
+    dot_ant = str(row.get('Dotación_ANT', ''))
+    dot_act = str(row.get('Dotación_ACT', ''))
+    ocu_ant = str(row.get('Ocupante_ANT', ''))
+    ocu_act = str(row.get('Ocupante_ACT', ''))
+    cambio_dot = dot_ant != dot_act and dot_ant != 'nan' and dot_act != 'nan'
+    cambio_ocu = ocu_ant != ocu_act
+    if cambio_dot and cambio_ocu: return '🔄 CAMBIO OCUPANTE + DOTACIÓN'
+    if cambio_dot:  return '💰 CAMBIO DOTACIÓN'
+    if cambio_ocu:  return '🔄 CAMBIO OCUPANTE'
+    return '✅ SIN CAMBIOS'
+
+def comparar_versiones(df_old, df_new):
+    """Cruza dos versiones por Código y clasifica cada plaza en su Situación."""
+    df_comp = pd.merge(df_old, df_new, on='Código', how='outer', suffixes=('_ANT','_ACT'), indicator=True)
+    df_comp['Situación']         = df_comp.apply(det_estado_comp, axis=1)
+    df_comp['Denominación']      = df_comp['Denominación_ACT'].fillna(df_comp['Denominación_ANT'])
+    df_comp['Grupo']             = df_comp['Grupo_ACT'].fillna(df_comp['Grupo_ANT'])
+    df_comp['Cuerpo']            = df_comp['Cuerpo_ACT'].fillna(df_comp['Cuerpo_ANT'])
+    df_comp['Provincia']         = df_comp['Provincia_ACT'].fillna(df_comp['Provincia_ANT'])
+    df_comp['Ocupante Anterior'] = df_comp['Ocupante_ANT'].fillna('-')
+    df_comp['Ocupante Actual']   = df_comp['Ocupante_ACT'].fillna('-')
+    df_comp['Dotación Anterior'] = df_comp['Dotación_ANT'].fillna('-')
+    df_comp['Dotación Actual']   = df_comp['Dotación_ACT'].fillna('-')
+    df_comp['Dotación']          = df_comp['Dotación_ACT'].fillna(df_comp['Dotación_ANT'])
+    df_comp['Estado']            = df_comp['Estado_Plaza_ACT'].fillna(df_comp['Estado_Plaza_ANT'])
+    return df_comp
+
+def contar_situaciones(df_comp):
+    """Devuelve el número de plazas de cada tipo de cambio."""
+    conteo = df_comp['Situación'].value_counts()
+    return {situacion: int(conteo.get(situacion, 0)) for situacion in SITUACIONES_CAMBIO}
+
+# ============================================================================
+# BÚSQUEDA DE OCUPANTES
+# ============================================================================
+TAMANO_NGRAMA = 3
+MAX_RESULTADOS_BUSQUEDA = 1000
+
+def normalizar_texto(texto):
+    """Mayúsculas, sin tildes ni signos: 'Núñez, José' -> 'NUNEZ JOSE'."""
+    sin_tildes = ''.join(c for c in unicodedata.normalize('NFKD', str(texto)) if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[^A-Z0-9]+', ' ', sin_tildes.upper()).split())
+
+def ngramas(termino):
+    return {termino[i:i + TAMANO_NGRAMA] for i in range(len(termino) - TAMANO_NGRAMA + 1)}
+
+def construir_indice_ocupantes(dataframes, info_archivos):
+    """Construye un índice invertido de ocupantes para toda la revisión.
+
+    Cada nombre normalizado distinto se indexa una sola vez por sus n-gramas
+    (aunque aparezca en todas las versiones) y apunta a sus apariciones.
+    Los DNI se indexan aparte para búsqueda exacta, con y sin letra.
+    """
+    apariciones = []        # (version, Código, Ocupante, DNI, Formacion, Estado_Plaza)
+    nombres = []            # nombres normalizados distintos
+    id_nombre = {}          # nombre normalizado -> posición en `nombres`
+    apariciones_nombre = [] # posición en `nombres` -> posiciones en `apariciones`
+    por_ngrama = {}         # n-grama -> conjunto de posiciones en `nombres`
+    por_dni = {}            # DNI (o sus 8 dígitos) -> posiciones en `apariciones`
+
+    for version, df in enumerate(dataframes):
+        columnas = [df['Código'], df['Ocupante'], df['DNI'], df['Formacion'], df['Estado_Plaza']]
+        for codigo, ocupante, dni, formacion, estado in zip(*columnas):
+            if not isinstance(ocupante, str) or ocupante == 'VACANTE':
+                continue
+            pos = len(apariciones)
+            apariciones.append((version, codigo, ocupante, dni, formacion, estado))
+
+            nombre_norm = normalizar_texto(ocupante)
+            n = id_nombre.get(nombre_norm)
+            if n is None:
+                n = len(nombres)
+                id_nombre[nombre_norm] = n
+                nombres.append(nombre_norm)
+                apariciones_nombre.append([])
+                for termino in nombre_norm.split():
+                    for g in ngramas(termino):
+                        por_ngrama.setdefault(g, set()).add(n)
+            apariciones_nombre[n].append(pos)
+
+            if isinstance(dni, str) and dni:
+                por_dni.setdefault(dni.upper(), []).append(pos)
+                por_dni.setdefault(dni[:8], []).append(pos)
+
+    return {
+        'versiones':          [(info['nombre'], info['fecha']) for info in info_archivos],
+        'apariciones':        apariciones,
+        'nombres':            nombres,
+        'apariciones_nombre': apariciones_nombre,
+        'ngramas':            por_ngrama,
+        'dni':                por_dni,
+    }
+
+def buscar_ocupante(indice, consulta):
+    """Busca por DNI exacto o por (parte del) nombre en el índice de ocupantes.
+
+    Para nombres, cada palabra de la consulta debe aparecer dentro del nombre
+    en cualquier orden; los n-gramas acotan los candidatos antes de comprobarlo.
+    Devuelve (DataFrame, truncado): como mucho MAX_RESULTADOS_BUSQUEDA
+    apariciones, tomadas siempre en el mismo orden (el de los nombres en el
+    índice), y si había más.
+    """
+    consulta = consulta.strip()
+    if re.fullmatch(r'\d{8}[A-Za-z]?', consulta):
+        posiciones = indice['dni'].get(consulta.upper(), [])
+    else:
+        terminos = normalizar_texto(consulta).split()
+        if not terminos:
+            return pd.DataFrame(), False
+        candidatos = None
+        for termino in terminos:
+            for g in ngramas(termino):
+                conjunto = indice['ngramas'].get(g, set())
+                candidatos = set(conjunto) if candidatos is None else candidatos & conjunto
+                if not candidatos:
+                    return pd.DataFrame(), False
+        if candidatos is None:
+            # Términos más cortos que un n-grama: recorrido de los nombres distintos
+            candidatos = range(len(indice['nombres']))
+        nombres = indice['nombres']
+        posiciones = []
+        for n in sorted(candidatos):
+            if all(termino in nombres[n] for termino in terminos):
+                posiciones.extend(indice['apariciones_nombre'][n])
+                if len(posiciones) > MAX_RESULTADOS_BUSQUEDA:
+                    break
+
+    truncado = len(posiciones) > MAX_RESULTADOS_BUSQUEDA
+    filas = []
+    for pos in sorted(posiciones[:MAX_RESULTADOS_BUSQUEDA]):
+        version, codigo, ocupante, dni, formacion, estado = indice['apariciones'][pos]
+        nombre_version, fecha_version = indice['versiones'][version]
+        filas.append({
+            'Versión':   f"V{version+1:02d} · {nombre_version}",
+            'Fecha':     fecha_version,
+            'Código':    codigo,
+            'Ocupante':  ocupante,
+            'DNI':       dni,
+            'Formacion': formacion,
+            'Estado':    estado,
+        })
+    return pd.DataFrame(filas), truncado
+
+# ============================================================================
+# EXPORTACIÓN DE LA REVISIÓN COMPLETA
+# ============================================================================
+FILAS_POR_LOTE = 5000
+DIR_EXPORTACIONES = Path(tempfile.gettempdir()) / "rpt_exports"
+
+def nombre_archivo_seguro(texto):
+    """Convierte un texto en un nombre de archivo sin caracteres problemáticos."""
+    limpio = re.sub(r'[^\w\-]+', '_', texto).strip('_')
+    return limpio or "revision"
+
+def valor_celda(valor):
+    """Adapta un valor de pandas a algo que el escritor XLSX acepte (sin NaN)."""
+    if valor is None or (not isinstance(valor, str) and pd.isna(valor)):
+        return None
+    return valor
+
+def iterar_lotes(df, columnas):
+    """Recorre un DataFrame por lotes de filas sin copiarlo entero."""
+    for inicio in range(0, len(df), FILAS_POR_LOTE):
+        yield df.iloc[inicio:inicio + FILAS_POR_LOTE][columnas]
+
+def tablas_exportacion(dataframes, info_archivos, comparaciones):
+    """Lista (nombre_hoja, DataFrame, columnas) de todo lo que se exporta.
+
+    Los nombres de hoja son cortos (máx. 31 caracteres en XLSX) y la
+    correspondencia con los archivos originales queda en los resúmenes.
+    """
+    resumen_versiones = pd.DataFrame([
+        {
+            'Hoja':       f"V{i+1:02d}",
+            'Archivo':    info['nombre'],
+            'Fecha':      info['fecha'],
+            'Total':      info['total_plazas'],
+            'Dotadas':    info['dotadas'],
+            'No dotadas': info['no_dotadas'],
+            'Ocupadas':   info['ocupadas'],
+            'Libres':     info['libres'],
+        }
+        for i, info in enumerate(info_archivos)
+    ])
+    filas_cambios = []
+    for i, df_comp in enumerate(comparaciones):
+        fila = {
+            'Hoja':              f"C{i+1:02d} V{i+1:02d}-V{i+2:02d}",
+            'Versión Anterior':  info_archivos[i]['nombre'],
+            'Versión Nueva':     info_archivos[i+1]['nombre'],
+        }
+        fila.update(contar_situaciones(df_comp))
+        filas_cambios.append(fila)
+    resumen_cambios = pd.DataFrame(filas_cambios)
+
+    tablas = [
+        ("Resumen Versiones", resumen_versiones, list(resumen_versiones.columns)),
+        ("Resumen Cambios",   resumen_cambios,   list(resumen_cambios.columns)),
+    ]
+    for i, df in enumerate(dataframes):
+        tablas.append((f"V{i+1:02d}", df, [c for c in COLS_VERSION if c in df.columns]))
+    for i, df_comp in enumerate(comparaciones):
+        tablas.append((f"C{i+1:02d} V{i+1:02d}-V{i+2:02d}", df_comp, COLS_COMPARACION))
+    return tablas
+
+def exportar_xlsx(ruta, tablas):
+    """Escribe todas las tablas en un XLSX multihoja fila a fila.
+
+    XlsxWriter en modo ``constant_memory`` vuelca cada fila a disco en cuanto
+    se escribe, así que la memoria no crece con el tamaño de la revisión.
+    """
+    with xlsxwriter.Workbook(str(ruta), {'constant_memory': True}) as libro:
+        formato_cabecera = libro.add_format({'bold': True, 'bg_color': '#0b6e3c', 'font_color': '#ffffff'})
+        for nombre_hoja, df, columnas in tablas:
+            hoja = libro.add_worksheet(nombre_hoja)
+            hoja.write_row(0, 0, columnas, formato_cabecera)
+            hoja.freeze_panes(1, 0)
+            fila_actual = 1
+            for lote in iterar_lotes(df, columnas):
+                for fila in lote.itertuples(index=False, name=None):
+                    hoja.write_row(fila_actual, 0, [valor_celda(v) for v in fila])
+                    fila_actual += 1
+
+def exportar_parquet(ruta_zip, tablas, dir_trabajo):
+    """Escribe cada tabla como Parquet por lotes y las empaqueta en un ZIP."""
+    dir_partes = Path(dir_trabajo) / "parquet"
+    dir_partes.mkdir(exist_ok=True)
+    with zipfile.ZipFile(ruta_zip, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for nombre_hoja, df, columnas in tablas:
+            nombre_parte = nombre_archivo_seguro(nombre_hoja) + ".parquet"
+            ruta_parte = dir_partes / nombre_parte
+            # Esquema fijado con la tabla completa para que todos los lotes coincidan;
+            # se infiere columna a columna para no copiar la tabla entera
+            esquema = pa.schema([
+                pa.Schema.from_pandas(df[[columna]], preserve_index=False).field(0)
+                for columna in columnas
+            ])
+            with pq.ParquetWriter(str(ruta_parte), esquema) as escritor:
+                for lote in iterar_lotes(df, columnas):
+                    escritor.write_table(pa.Table.from_pandas(lote, schema=esquema, preserve_index=False))
+            zf.write(ruta_parte, arcname=nombre_parte)
+            ruta_parte.unlink()
+
+def generar_exportacion(nombre_revision, dataframes, info_archivos, comparaciones):
+    """Genera el XLSX y el ZIP de Parquet en un directorio temporal.
+
+    Devuelve un diccionario con las rutas de ambos archivos y del directorio,
+    para poder servirlos con ``st.download_button`` y borrarlos después.
+    """
+    DIR_EXPORTACIONES.mkdir(parents=True, exist_ok=True)
+    dir_trabajo = Path(tempfile.mkdtemp(prefix="rpt_export_", dir=DIR_EXPORTACIONES))
+    base = nombre_archivo_seguro(nombre_revision or "revision")
+    tablas = tablas_exportacion(dataframes, info_archivos, comparaciones)
+    ruta_xlsx = dir_trabajo / f"{base}.xlsx"
+    ruta_zip = dir_trabajo / f"{base}_parquet.zip"
+    try:
+        exportar_xlsx(ruta_xlsx, tablas)
+        exportar_parquet(ruta_zip, tablas, dir_trabajo)
+    except Exception:
+        # No dejar exportaciones a medias en disco
+        shutil.rmtree(dir_trabajo, ignore_errors=True)
+        raise
+    return {'dir': str(dir_trabajo), 'xlsx': str(ruta_xlsx), 'parquet': str(ruta_zip)}
+
+def borrar_exportacion(exportacion):
+    """Elimina del disco los archivos de una exportación anterior."""
+    if exportacion:
+        shutil.rmtree(exportacion['dir'], ignore_errors=True)
+
+@st.fragment
+def panel_exportacion(nombre_revision, dataframes, info_archivos, comparaciones):
+    """Genera la exportación y ofrece las descargas solo tras pulsar el botón.
+
+    Los botones de descarga cargan el archivo entero en memoria al
+    dibujarse, así que no se muestran en los reruns normales de la página:
+    solo en la ejecución del fragmento que sigue al clic. Si los archivos
+    ya existen se reutilizan en lugar de generarlos de nuevo.
+    """
+    st.caption("Todas las versiones, todas las comparaciones con su Situación y los resúmenes, "
+               "en un Excel multihoja y en un ZIP de archivos Parquet.")
+    if not st.button("📦 Preparar descargas", key="btn_exportar"):
+        return
+    exportacion = st.session_state.exportacion
+    if exportacion and Path(exportacion['xlsx']).exists() and Path(exportacion['parquet']).exists():
+        os.utime(exportacion['dir'])
+    else:
+        with st.spinner("📦 Generando exportación..."):
+            borrar_exportacion(exportacion)
+            st.session_state.exportacion = None
+            try:
+                exportacion = generar_exportacion(nombre_revision, dataframes, info_archivos, comparaciones)
+            except Exception as e:
+                st.error(f"❌ No se pudo generar la exportación: {e}")
+                with st.expander("🔍 Ver detalles técnicos"):
+                    st.code(traceback.format_exc())
+                return
+            st.session_state.exportacion = exportacion
+    col_x, col_p = st.columns(2)
+    with open(exportacion['xlsx'], 'rb') as f_xlsx:
+        col_x.download_button(
+            "⬇️ Descargar Excel (XLSX)", data=f_xlsx,
+            file_name=Path(exportacion['xlsx']).name,
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            on_click="ignore", key="dl_xlsx"
+        )
+    with open(exportacion['parquet'], 'rb') as f_zip:
+        col_p.download_button(
+            "⬇️ Descargar Parquet (ZIP)", data=f_zip,
+            file_name=Path(exportacion['parquet']).name,
+            mime="application/zip",
+            on_click="ignore", key="dl_parquet"
+        )
+
+# ============================================================================
+# CACHÉ COMPARTIDA DE VERSIONES Y COMPARACIONES
+# ============================================================================
+PRESUPUESTO_CACHE_VERSIONES = 512 * 1024 * 1024  # bytes
+
+@st.cache_resource
+def obtener_cache_versiones():
+    """Caché LRU del proceso, compartida por todas las sesiones.
+
+    Guarda las líneas extraídas de cada página (por huella de la página), las
+    versiones procesadas (por huella del PDF), las comparaciones (por par de
+    huellas) y la correspondencia archivo de Drive -> huella.
+    Los valores se comparten entre sesiones y no deben modificarse.
+    Aciertos y fallos se cuentan por tipo de clave ('version', 'comparacion',
+    'drive', ...) para que cada tasa mida lo que dice medir.
+    """
+    return {
+        'lock':        threading.Lock(),
+        'entradas':    OrderedDict(),  # clave -> (valor, tamaño en bytes)
+        'bytes':       0,
+        'presupuesto': PRESUPUESTO_CACHE_VERSIONES,
+        'aciertos':    {},             # tipo -> nº de aciertos
+        'fallos':      {},             # tipo -> nº de fallos
+        'expulsiones': 0,
+    }
+
+def tamano_en_memoria(valor):
+    if isinstance(valor, pd.DataFrame):
+        return int(valor.memory_usage(index=True, deep=True).sum())
+    if isinstance(valor, list):
+        # Líneas de una página: la lista más cada cadena
+        return sys.getsizeof(valor) + sum(sys.getsizeof(elemento) for elemento in valor)
+    return sys.getsizeof(valor)
+
+def cache_lru_obtener(cache, clave):
+    tipo = clave[0]
+    with cache['lock']:
+        entrada = cache['entradas'].get(clave)
+        if entrada is None:
+            cache['fallos'][tipo] = cache['fallos'].get(tipo, 0) + 1
+            return None
+        cache['entradas'].move_to_end(clave)
+        cache['aciertos'][tipo] = cache['aciertos'].get(tipo, 0) + 1
+        return entrada[0]
+
+def cache_lru_guardar(cache, clave, valor):
+    """Guarda un valor y expulsa los menos usados hasta caber en el presupuesto."""
+    tamano = tamano_en_memoria(valor)
+    if tamano > cache['presupuesto']:
+        return
+    with cache['lock']:
+        anterior = cache['entradas'].pop(clave, None)
+        if anterior is not None:
+            cache['bytes'] -= anterior[1]
+        cache['entradas'][clave] = (valor, tamano)
+        cache['bytes'] += tamano
+        while cache['bytes'] > cache['presupuesto']:
+            _, (_, tamano_expulsado) = cache['entradas'].popitem(last=False)
+            cache['bytes'] -= tamano_expulsado
+            cache['expulsiones'] += 1
+
+def estadisticas_cache(cache):
+    """Ocupación de la caché y (aciertos, fallos, tasa) por tipo de clave."""
+    with cache['lock']:
+        por_tipo = {}
+        for tipo in set(cache['aciertos']) | set(cache['fallos']):
+            aciertos = cache['aciertos'].get(tipo, 0)
+            fallos = cache['fallos'].get(tipo, 0)
+            por_tipo[tipo] = (aciertos, fallos, aciertos / (aciertos + fallos))
+        return {
+            'entradas':    len(cache['entradas']),
+            'mb':          cache['bytes'] / (1024 * 1024),
+            'expulsiones': cache['expulsiones'],
+            'por_tipo':    por_tipo,
+        }
+
+# ============================================================================
+# CUBO DE AGREGADOS (panel por Provincia × Grupo × Dotación × Estado)
+# ============================================================================
+DIMENSIONES_CUBO = ['Provincia', 'Grupo', 'Dotación', 'Estado']
+
+def agregar_version(df):
+    """Un único groupby por versión: nº de plazas por cada combinación de dimensiones."""
+    claves = [df['Provincia'], df['Grupo'], df['Dotación'], df['Estado_Plaza'].rename('Estado')]
+    agregado = df.groupby(claves, dropna=False).size().reset_index(name='Plazas')
+    agregado['Grupo'] = agregado['Grupo'].fillna('SIN GRUPO')
+    return agregado
+
+def agregar_comparacion(df_comp):
+    """Un único groupby por comparación: nº de plazas por dimensiones y Situación."""
+    agregado = (df_comp.groupby(DIMENSIONES_CUBO + ['Situación'], dropna=False).size()
+                       .reset_index(name='Plazas'))
+    agregado['Grupo'] = agregado['Grupo'].fillna('SIN GRUPO')
+    return agregado
+
+def etiqueta_version(i, info):
+    return f"V{i+1:02d} · {info['fecha']}"
+
+def construir_cubo(agregados_versiones, agregados_cambios, info_archivos):
+    """Une los agregados de todas las versiones y comparaciones en dos tablas largas.
+
+    El panel solo lee de aquí: pivota y filtra sobre unas pocas miles de
+    filas en lugar de volver a recorrer los DataFrames completos.
+    """
+    partes_versiones = []
+    for i, agregado in enumerate(agregados_versiones):
+        parte = agregado.copy()
+        parte.insert(0, 'Versión', etiqueta_version(i, info_archivos[i]))
+        partes_versiones.append(parte)
+    partes_cambios = []
+    for i, agregado in enumerate(agregados_cambios):
+        parte = agregado.copy()
+        parte.insert(0, 'Comparación', f"V{i+1:02d}→V{i+2:02d}")
+        partes_cambios.append(parte)
+    return {
+        'versiones': pd.concat(partes_versiones, ignore_index=True) if partes_versiones else pd.DataFrame(),
+        'cambios':   pd.concat(partes_cambios, ignore_index=True) if partes_cambios else pd.DataFrame(),
+    }
+
+# ============================================================================
+# COLA DE TRABAJOS EN SEGUNDO PLANO
+# ============================================================================
+MAX_TRABAJADORES = 2
+SEGUNDOS_REFRESCO_TRABAJO = 1
+SEGUNDOS_ESPERA_INICIAL = 0.5
+SEGUNDOS_CONSERVAR_TRABAJO = 15 * 60
+
+@st.cache_resource
+def obtener_cola_trabajos():
+    """Pool de hilos y registro de trabajos compartidos por todas las sesiones."""
+    return {
+        'lock':      threading.Lock(),
+        'pool':      ThreadPoolExecutor(max_workers=MAX_TRABAJADORES, thread_name_prefix="rpt-trabajo"),
+        'trabajos':  {},
+    }
+
+def huella_revision(archivos_lista):
+    """Hash del contenido (nombres y huellas) de todos los PDFs de una revisión."""
+    h = hashlib.sha256()
+    for nombre, huella in sorted(archivos_lista):
+        h.update(nombre.encode())
+        h.update(huella.encode())
+    return h.hexdigest()
+
+def procesar_revision(archivos_lista, cache_versiones, trabajo):
+    """Ordena, procesa y compara todos los PDFs de una revisión.
+
+    Se ejecuta en un hilo del pool, fuera del ciclo de reruns de Streamlit,
+    por lo que no llama a `st`: el progreso se publica en `trabajo` y los
+    mensajes se devuelven en 'avisos' para mostrarlos al recoger el resultado.
+    Las versiones y comparaciones ya calculadas por cualquier sesión se toman
+    de `cache_versiones`.
+    """
+    avisos = []
+    trabajo['mensaje'] = "🔄 Ordenando archivos cronológicamente..."
+    archivos_ordenados = ordenar_archivos_por_fecha(archivos_lista, cache_versiones)
+    num_archivos = len(archivos_ordenados)
+    # Cada archivo cuenta un paso y el conjunto de comparaciones otro
+    pasos_totales = num_archivos + 1
+    dataframes = []
+    huellas = []
+    info_archivos = []
+
+    for i, (nombre, huella, fecha) in enumerate(archivos_ordenados):
+        trabajo['mensaje'] = f"📄 Procesando archivo {i+1}/{num_archivos}: {nombre}"
+        df = cache_lru_obtener(cache_versiones, ('version', huella))
+        if df is not None:
+            avisos.append(('info', f"♻️ {nombre}: {len(df):,} plazas reutilizadas de la caché compartida", None))
+        else:
+            try:
+                with abrir_pdf_almacen(huella) as datos:
+                    df = procesar_pdf(datos, nombre, cache_versiones, avisos)
+            except FileNotFoundError:
+                avisos.append(('error', f"❌ {nombre} ya no está en el almacén temporal. Vuelve a cargar la revisión.", None))
+                df = pd.DataFrame()
+            except ValueError:
+                # mmap de un archivo vacío
+                avisos.append(('error', f"❌ {nombre}: no se extrajeron plazas.", None))
+                df = pd.DataFrame()
+            if not df.empty:
+                cache_lru_guardar(cache_versiones, ('version', huella), df)
+        if not df.empty:
+            dataframes.append(df)
+            huellas.append(huella)
+            info_archivos.append({
+                'nombre':       nombre,
+                'fecha':        fecha,
+                'total_plazas': len(df),
+                'dotadas':      len(df[df['Dotación'] == 'DOTADA']),
+                'no_dotadas':   len(df[df['Dotación'] == 'NO DOTADA']),
+                'ocupadas':     len(df[df['Estado_Plaza'] == 'OCUPADA']),
+                'libres':       len(df[df['Estado_Plaza'] == 'LIBRE'])
+            })
+        else:
+            avisos.append(('error', f"⚠️ No se pudieron extraer datos de {nombre}", None))
+        trabajo['progreso'] = (i + 1) / pasos_totales
+
+    trabajo['mensaje'] = "🔀 Comparando versiones..."
+    comparaciones = []
+    for i in range(len(dataframes) - 1):
+        clave_comp = ('comparacion', huellas[i], huellas[i + 1])
+        df_comp = cache_lru_obtener(cache_versiones, clave_comp)
+        if df_comp is None:
+            df_comp = comparar_versiones(dataframes[i], dataframes[i + 1])
+            cache_lru_guardar(cache_versiones, clave_comp, df_comp)
+        comparaciones.append(df_comp)
+
+    trabajo['mensaje'] = "📈 Calculando agregados..."
+    agregados_versiones = []
+    for huella, df in zip(huellas, dataframes):
+        agregado = cache_lru_obtener(cache_versiones, ('cubo_version', huella))
+        if agregado is None:
+            agregado = agregar_version(df)
+            cache_lru_guardar(cache_versiones, ('cubo_version', huella), agregado)
+        agregados_versiones.append(agregado)
+    agregados_cambios = []
+    for i, df_comp in enumerate(comparaciones):
+        clave_cubo = ('cubo_comparacion', huellas[i], huellas[i + 1])
+        agregado = cache_lru_obtener(cache_versiones, clave_cubo)
+        if agregado is None:
+            agregado = agregar_comparacion(df_comp)
+            cache_lru_guardar(cache_versiones, clave_cubo, agregado)
+        agregados_cambios.append(agregado)
+    cubo = construir_cubo(agregados_versiones, agregados_cambios, info_archivos)
+    trabajo['progreso'] = 1.0
+    trabajo['mensaje'] = "✅ Procesamiento terminado"
+    return {
+        'dataframes':    dataframes,
+        'comparaciones': comparaciones,
+        'info_archivos': info_archivos,
+        'cubo':          cubo,
+        'avisos':        avisos,
+    }
+
+def purgar_trabajos(cola):
+    """Quita del registro los trabajos terminados hace tiempo (llamar con el lock)."""
+    limite = time.time() - SEGUNDOS_CONSERVAR_TRABAJO
+    for clave in [c for c, t in cola['trabajos'].items() if t['terminado'] and t['terminado'] < limite]:
+        del cola['trabajos'][clave]
+
+def enviar_trabajo(archivos_lista):
+    """Encola el procesamiento de una revisión y devuelve su clave.
+
+    Si ya hay un trabajo con el mismo contenido (de esta u otra sesión), en
+    curso o terminado con éxito, se reutiliza en lugar de lanzar otro.
+    """
+    clave = huella_revision(archivos_lista)
+    cola = obtener_cola_trabajos()
+    cache_versiones = obtener_cache_versiones()
+    with cola['lock']:
+        purgar_trabajos(cola)
+        trabajo = cola['trabajos'].get(clave)
+        if trabajo is None or (trabajo['future'].done() and trabajo['future'].exception() is not None):
+            trabajo = {
+                'clave':     clave,
+                'progreso':  0.0,
+                'mensaje':   "⏳ En cola...",
+                'terminado': None,
+            }
+            trabajo['future'] = cola['pool'].submit(procesar_revision, list(archivos_lista), cache_versiones, trabajo)
+            trabajo['future'].add_done_callback(lambda _f, t=trabajo: t.update(terminado=time.time()))
+            cola['trabajos'][clave] = trabajo
+    return clave
+
+def consultar_trabajo(clave):
+    cola = obtener_cola_trabajos()
+    with cola['lock']:
+        purgar_trabajos(cola)
+        return cola['trabajos'].get(clave)
+
+def descartar_trabajo(clave):
+    cola = obtener_cola_trabajos()
+    with cola['lock']:
+        cola['trabajos'].pop(clave, None)
+
+@st.fragment(run_every=SEGUNDOS_REFRESCO_TRABAJO)
+def progreso_trabajo(clave):
+    """Muestra el progreso de un trabajo refrescando solo este fragmento.
+
+    Así la espera no vuelve a ejecutar todo el script (barra lateral con sus
+    llamadas a Drive incluida) cada segundo; la página completa se recarga
+    una única vez, cuando el trabajo ha terminado.
+    """
+    trabajo = consultar_trabajo(clave)
+    if trabajo is None or trabajo['future'].done():
+        st.rerun()
+    st.markdown("### 📊 Progreso de Procesamiento")
+    st.progress(trabajo['progreso'], text=trabajo['mensaje'])
+    st.caption("⏳ El procesamiento continúa en segundo plano aunque pulses otros controles o recargues la revisión.")
+
+def mostrar_avisos(avisos):
+    """Muestra en la página los mensajes acumulados por procesar_pdf."""
+    for tipo, texto, detalle in avisos:
+        getattr(st, tipo)(texto)
+        if detalle:
+            with st.expander("🔍 Ver detalles técnicos"):
+                st.code(detalle)
+
 # ============================================================================
 # SIDEBAR - REVISIONES GUARDADAS
 # ============================================================================
+limpiar_almacen_pdf()
 service = conectar_drive()
+cache_versiones = obtener_cache_versiones()
 
 with st.sidebar:
     st.markdown("## 📁 Revisiones Guardadas")
@@ -396,15 +1245,24 @@ with st.sidebar:
                         # Cargar PDFs de esta revisión
                         with st.spinner(f"Cargando {rev['name']}..."):
                             pdfs = listar_pdfs_revision(service, rev['id'])
-                            if len(pdfs) >= 2:
-                                archivos_lista = []
-                                for pdf in pdfs:
-                                    bytes_pdf = descargar_pdf_drive(service, pdf['id'])
-                                    archivos_lista.append((pdf['name'], bytes_pdf))
+                            archivos_lista = []
+                            for pdf in pdfs:
+                                # Si otra sesión ya descargó este archivo, se reutiliza sin descargar
+                                clave_drive = ('drive', pdf['id'], pdf.get('md5Checksum'))
+                                huella = cache_lru_obtener(cache_versiones, clave_drive)
+                                if huella is None or not ruta_pdf_almacen(huella).exists():
+                                    try:
+                                        huella = guardar_pdf_almacen(descargar_pdf_drive(service, pdf['id']))
+                                    except ValueError:
+                                        st.warning(f"Archivo vacío: {pdf['name']}")
+                                        continue
+                                    if pdf.get('md5Checksum'):
+                                        cache_lru_guardar(cache_versiones, clave_drive, huella)
+                                archivos_lista.append((pdf['name'], huella))
+                            if len(archivos_lista) >= 2:
+                                reiniciar_sesion()
                                 st.session_state.archivos_procesados = archivos_lista
                                 st.session_state.comparacion_ejecutada = True
-                                st.session_state.dataframes_procesados = None
-                                st.session_state.info_archivos = None
                                 st.session_state.revision_activa = rev['name']
                                 st.rerun()
                             else:
@@ -417,13 +1275,20 @@ with st.sidebar:
 
     st.markdown("---")
     if st.button("🔄 Nueva Comparación"):
-        st.session_state.archivos_procesados = None
-        st.session_state.comparacion_ejecutada = False
-        st.session_state.dataframes_procesados = None
-        st.session_state.info_archivos = None
-        st.session_state.revision_activa = None
+        reiniciar_sesion()
         st.rerun()
 
+    est_cache = estadisticas_cache(cache_versiones)
+    partes_tasas = []
+    for tipo, etiqueta in [('pagina', 'páginas'), ('version', 'versiones'), ('comparacion', 'comparaciones'), ('drive', 'Drive')]:
+        if tipo in est_cache['por_tipo']:
+            aciertos, fallos, tasa = est_cache['por_tipo'][tipo]
+            partes_tasas.append(f"{etiqueta}: {aciertos}/{aciertos + fallos} ({tasa:.0%})")
+    tasas_cache = " · ".join(partes_tasas)
+    st.caption(f"🗄️ Caché compartida: {est_cache['entradas']} entradas · {est_cache['mb']:.0f} MB · "
+               f"{est_cache['expulsiones']} expulsiones"
+               + (f" · aciertos {tasas_cache}" if tasas_cache else ""))
+
 # ============================================================================
 # PANTALLA DE CARGA
 # ============================================================================
@@ -493,7 +1358,7 @@ if not st.session_state.comparacion_ejecutada:
                         else:
                             nombres_vistos[nombre_base] = 1
                             nombre_unico = nombre_base
-                        archivos_lista.append((nombre_unico, contenido_bytes))
+                        archivos_lista.append((nombre_unico, guardar_pdf_almacen(contenido_bytes)))
                     except Exception as e:
                         st.warning(f"Error leyendo {archivo.name}: {e}")
 
@@ -504,8 +1369,9 @@ if not st.session_state.comparacion_ejecutada:
                             try:
                                 carpeta_raiz_id = obtener_o_crear_carpeta(service, CARPETA_RAIZ_NOMBRE)
                                 carpeta_rev_id = obtener_o_crear_carpeta(service, nombre_revision.strip(), carpeta_raiz_id)
-                                for nombre_arch, bytes_pdf in archivos_lista:
-                                    subir_pdf_drive(service, nombre_arch, bytes_pdf, carpeta_rev_id)
+                                for nombre_arch, huella in archivos_lista:
+                                    with abrir_pdf_almacen(huella) as datos:
+                                        subir_pdf_drive(service, nombre_arch, datos, carpeta_rev_id)
                                 st.success(f"✅ Revisión '{nombre_revision}' guardada en Google Drive")
                             except Exception as e:
                                 st.warning(f"⚠️ No se pudo guardar en Drive: {e}")
@@ -535,36 +1401,49 @@ if st.session_state.comparacion_ejecutada and st.session_state.archivos_procesad
     st.markdown("---")
 
     if st.session_state.dataframes_procesados is None:
-        with st.spinner('🔄 Procesando y ordenando archivos cronológicamente...'):
-            archivos_ordenados = ordenar_archivos_por_fecha(st.session_state.archivos_procesados)
-            dataframes_procesados = []
-            info_archivos = []
-
-            st.markdown("### 📊 Progreso de Procesamiento")
-
-            for i, (nombre, archivo_bytes, fecha) in enumerate(archivos_ordenados):
-                st.markdown(f"**Procesando archivo {i+1}/{len(archivos_ordenados)}:** {nombre}")
-                df = procesar_pdf(archivo_bytes, nombre)
-                if not df.empty:
-                    dataframes_procesados.append(df)
-                    info_archivos.append({
-                        'nombre':       nombre,
-                        'fecha':        fecha,
-                        'total_plazas': len(df),
-                        'dotadas':      len(df[df['Dotación'] == 'DOTADA']),
-                        'no_dotadas':   len(df[df['Dotación'] == 'NO DOTADA']),
-                        'ocupadas':     len(df[df['Estado_Plaza'] == 'OCUPADA']),
-                        'libres':       len(df[df['Estado_Plaza'] == 'LIBRE'])
-                    })
-                else:
-                    st.error(f"⚠️ No se pudieron extraer datos de {nombre}")
-
-            st.markdown("---")
+        if st.session_state.trabajo_activo is None:
+            st.session_state.trabajo_activo = enviar_trabajo(st.session_state.archivos_procesados)
+        trabajo = consultar_trabajo(st.session_state.trabajo_activo)
+        if trabajo is None:
+            # Purgado antes de recogerlo: se vuelve a encolar en la siguiente ejecución
+            st.session_state.trabajo_activo = None
+            st.rerun()
 
+        # Una revisión ya en la caché compartida termina casi al instante:
+        # se espera un momento para no pasar por el ciclo de sondeo
+        wait([trabajo['future']], timeout=SEGUNDOS_ESPERA_INICIAL)
+        if not trabajo['future'].done():
+            progreso_trabajo(trabajo['clave'])
+            st.stop()
+
+        st.session_state.trabajo_activo = None
+        if trabajo['future'].exception() is not None:
+            error = trabajo['future'].exception()
+            descartar_trabajo(trabajo['clave'])
+            st.error(f"❌ Error procesando la revisión: {error}")
+            with st.expander("🔍 Ver detalles técnicos"):
+                st.code(''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+            resultado = {'dataframes': [], 'comparaciones': [], 'info_archivos': [], 'cubo': None, 'avisos': []}
+        else:
+            resultado = trabajo['future'].result()
+            # El registro solo sirve para unir envíos en curso: una vez recogido,
+            # quitarlo deja que la LRU sea la única que retiene los DataFrames
+            # (otras sesiones que lo pidan después los obtienen de la caché).
+            descartar_trabajo(trabajo['clave'])
+
+        with st.expander("📊 Registro de procesamiento", expanded=len(resultado['dataframes']) < 2):
+            mostrar_avisos(resultado['avisos'])
+
+        dataframes_procesados = resultado['dataframes']
+        comparaciones_procesadas = resultado['comparaciones']
+        info_archivos = resultado['info_archivos']
         st.session_state.dataframes_procesados = dataframes_procesados
+        st.session_state.comparaciones_procesadas = comparaciones_procesadas
         st.session_state.info_archivos = info_archivos
+        st.session_state.cubo_agregados = resultado['cubo']
     else:
         dataframes_procesados = st.session_state.dataframes_procesados
+        comparaciones_procesadas = st.session_state.comparaciones_procesadas
         info_archivos = st.session_state.info_archivos
 
     if len(dataframes_procesados) >= 2:
@@ -578,6 +1457,89 @@ if st.session_state.comparacion_ejecutada and st.session_state.archivos_procesad
         col1.metric("Plazas Iniciales",   total_plazas_base,  help=f"Archivo: {info_archivos[0]['nombre']}")
         col2.metric("Plazas Finales",     total_plazas_final, delta=diferencia, help=f"Archivo: {info_archivos[-1]['nombre']}")
         col3.metric("Total de Versiones", len(dataframes_procesados))
+
+        with st.expander("📥 Exportar revisión completa"):
+            panel_exportacion(st.session_state.revision_activa, dataframes_procesados,
+                              info_archivos, comparaciones_procesadas)
+        st.markdown("---")
+
+        st.markdown("### 🔎 Buscar Ocupante")
+        if st.session_state.indice_ocupantes is None:
+            with st.spinner("🔎 Indexando ocupantes de todas las versiones..."):
+                st.session_state.indice_ocupantes = construir_indice_ocupantes(dataframes_procesados, info_archivos)
+        consulta_ocupante = st.text_input(
+            "Nombre (o parte) o DNI",
+            placeholder="Ej: GARCIA LOPEZ · 12345678Z",
+            key="busqueda_ocupante"
+        )
+        if consulta_ocupante.strip():
+            t_inicio = time.perf_counter()
+            df_busqueda, busqueda_truncada = buscar_ocupante(st.session_state.indice_ocupantes, consulta_ocupante)
+            t_ms = (time.perf_counter() - t_inicio) * 1000
+            if df_busqueda.empty:
+                st.info(f"Sin resultados para '{consulta_ocupante}'.")
+            else:
+                st.dataframe(df_busqueda, width='stretch', height=min(400, 38 + 35 * len(df_busqueda)))
+                st.caption(f"{len(df_busqueda)} apariciones en {df_busqueda['Versión'].nunique()} versiones · {t_ms:.1f} ms")
+                if busqueda_truncada:
+                    st.warning(f"⚠️ Hay más de {MAX_RESULTADOS_BUSQUEDA} apariciones: solo se muestran las primeras. "
+                               "Escribe el nombre más completo o busca por DNI.")
+        st.markdown("---")
+
+        st.markdown("## 📈 Panel de Agregados")
+        cubo = st.session_state.cubo_agregados
+        if cubo is None:
+            # El cubo se calcula siempre en el trabajo de procesamiento; el panel
+            # no recalcula nada a partir de los DataFrames completos.
+            st.error("⚠️ No hay agregados para esta revisión. Vuelve a cargarla para calcularlos.")
+        else:
+            cubo_versiones = cubo['versiones']
+            cubo_cambios = cubo['cambios']
+            versiones_cubo = list(dict.fromkeys(cubo_versiones['Versión']))
+
+            panel_pivot, panel_plazas, panel_cambios = st.tabs(
+                ["📊 Tabla dinámica", "📈 Evolución de plazas", "🔀 Evolución de cambios"]
+            )
+
+            with panel_pivot:
+                cp1, cp2, cp3 = st.columns(3)
+                with cp1:
+                    version_pivot = st.selectbox("Versión", options=versiones_cubo, index=len(versiones_cubo) - 1, key="cubo_version")
+                with cp2:
+                    filas_pivot = st.selectbox("Filas", options=DIMENSIONES_CUBO, index=0, key="cubo_filas")
+                with cp3:
+                    cols_pivot = st.selectbox("Columnas", options=[d for d in DIMENSIONES_CUBO if d != filas_pivot], key="cubo_columnas")
+                df_pivot = cubo_versiones[cubo_versiones['Versión'] == version_pivot].pivot_table(
+                    values='Plazas', index=filas_pivot, columns=cols_pivot,
+                    aggfunc='sum', fill_value=0, margins=True, margins_name='TOTAL'
+                )
+                st.dataframe(df_pivot, width='stretch')
+
+            with panel_plazas:
+                ce1, ce2 = st.columns(2)
+                with ce1:
+                    desglose_plazas = st.selectbox("Desglosar por", options=DIMENSIONES_CUBO, index=3, key="cubo_desglose")
+                with ce2:
+                    prov_plazas = st.multiselect("Provincia", options=sorted(cubo_versiones['Provincia'].unique()), key="cubo_prov_plazas")
+                df_evol = cubo_versiones
+                if prov_plazas: df_evol = df_evol[df_evol['Provincia'].isin(prov_plazas)]
+                df_evol = df_evol.pivot_table(values='Plazas', index='Versión', columns=desglose_plazas, aggfunc='sum', fill_value=0)
+                st.line_chart(df_evol)
+                st.dataframe(df_evol, width='stretch')
+
+            with panel_cambios:
+                cc1, cc2 = st.columns(2)
+                with cc1:
+                    prov_cambios = st.multiselect("Provincia", options=sorted(cubo_cambios['Provincia'].unique()), key="cubo_prov_cambios")
+                with cc2:
+                    grupo_cambios = st.multiselect("Grupo", options=sorted(cubo_cambios['Grupo'].unique()), key="cubo_grupo_cambios")
+                df_camb = cubo_cambios[cubo_cambios['Situación'].isin(SITUACIONES_CAMBIO)]
+                if prov_cambios:  df_camb = df_camb[df_camb['Provincia'].isin(prov_cambios)]
+                if grupo_cambios: df_camb = df_camb[df_camb['Grupo'].isin(grupo_cambios)]
+                df_camb = (df_camb.pivot_table(values='Plazas', index='Comparación', columns='Situación', aggfunc='sum', fill_value=0)
+                                  .reindex(columns=SITUACIONES_CAMBIO, fill_value=0))
+                st.bar_chart(df_camb)
+                st.dataframe(df_camb, width='stretch')
         st.markdown("---")
 
         st.markdown("## 🔀 Comparaciones Detalladas Entre Versiones")
@@ -601,39 +1563,14 @@ if st.session_state.comparacion_ejecutada and st.session_state.archivos_procesad
                 with col_comp2:
                     st.success(f"**📋 Versión Nueva**\n\n{info_archivos[idx+1]['nombre']}\n\n📅 {info_archivos[idx+1]['fecha']}")
 
-                df_comp = pd.merge(df_old, df_new, on='Código', how='outer', suffixes=('_ANT','_ACT'), indicator=True)
-
-                def det_estado_comp(row):
-                    if row['_merge'] == 'left_only':  return '❌ ELIMINADA'
-                    if row['_merge'] == 'right_only': return '🆕 NUEVA'
-                    dot_ant = str(row.get('Dotación_ANT', ''))
-                    dot_act = str(row.get('Dotación_ACT', ''))
-                    ocu_ant = str(row.get('Ocupante_ANT', ''))
-                    ocu_act = str(row.get('Ocupante_ACT', ''))
-                    cambio_dot = dot_ant != dot_act and dot_ant != 'nan' and dot_act != 'nan'
-                    cambio_ocu = ocu_ant != ocu_act
-                    if cambio_dot and cambio_ocu: return '🔄 CAMBIO OCUPANTE + DOTACIÓN'
-                    if cambio_dot:  return '💰 CAMBIO DOTACIÓN'
-                    if cambio_ocu:  return '🔄 CAMBIO OCUPANTE'
-                    return '✅ SIN CAMBIOS'
-
-                df_comp['Situación']         = df_comp.apply(det_estado_comp, axis=1)
-                df_comp['Denominación']      = df_comp['Denominación_ACT'].fillna(df_comp['Denominación_ANT'])
-                df_comp['Grupo']             = df_comp['Grupo_ACT'].fillna(df_comp['Grupo_ANT'])
-                df_comp['Cuerpo']            = df_comp['Cuerpo_ACT'].fillna(df_comp['Cuerpo_ANT'])
-                df_comp['Provincia']         = df_comp['Provincia_ACT'].fillna(df_comp['Provincia_ANT'])
-                df_comp['Ocupante Anterior'] = df_comp['Ocupante_ANT'].fillna('-')
-                df_comp['Ocupante Actual']   = df_comp['Ocupante_ACT'].fillna('-')
-                df_comp['Dotación Anterior'] = df_comp['Dotación_ANT'].fillna('-')
-                df_comp['Dotación Actual']   = df_comp['Dotación_ACT'].fillna('-')
-                df_comp['Dotación']          = df_comp['Dotación_ACT'].fillna(df_comp['Dotación_ANT'])
-                df_comp['Estado']            = df_comp['Estado_Plaza_ACT'].fillna(df_comp['Estado_Plaza_ANT'])
-
-                nuevas        = len(df_comp[df_comp['Situación'] == '🆕 NUEVA'])
-                eliminadas    = len(df_comp[df_comp['Situación'] == '❌ ELIMINADA'])
-                cambios_ocu   = len(df_comp[df_comp['Situación'] == '🔄 CAMBIO OCUPANTE'])
-                cambios_dot   = len(df_comp[df_comp['Situación'] == '💰 CAMBIO DOTACIÓN'])
-                cambios_ambos = len(df_comp[df_comp['Situación'] == '🔄 CAMBIO OCUPANTE + DOTACIÓN'])
+                df_comp = comparaciones_procesadas[idx]
+
+                conteo = contar_situaciones(df_comp)
+                nuevas        = conteo['🆕 NUEVA']
+                eliminadas    = conteo['❌ ELIMINADA']
+                cambios_ocu   = conteo['🔄 CAMBIO OCUPANTE']
+                cambios_dot   = conteo['💰 CAMBIO DOTACIÓN']
+                cambios_ambos = conteo['🔄 CAMBIO OCUPANTE + DOTACIÓN']
 
                 col_m1, col_m2, col_m3, col_m4, col_m5 = st.columns(5)
                 col_m1.metric("🆕 Nuevas",         nuevas,     delta=f"+{nuevas}")
@@ -690,11 +1627,7 @@ if st.session_state.comparacion_ejecutada and st.session_state.archivos_procesad
                     tab_ant, tab_act,
                 ])
 
-                cols_mostrar = [
-                    'Código', 'Denominación', 'Grupo', 'Cuerpo', 'Provincia', 'Situación',
-                    'Dotación Anterior', 'Dotación Actual', 'Estado',
-                    'Ocupante Anterior', 'Ocupante Actual'
-                ]
+                cols_mostrar = COLS_COMPARACION
 
                 def color_rows(val):
                     if val == '❌ ELIMINADA':                    return 'background-color: #ffebee'
@@ -788,19 +1721,11 @@ if st.session_state.comparacion_ejecutada and st.session_state.archivos_procesad
 
         st.markdown("---")
         if st.button("🔄 Cargar Nuevos Archivos", type="secondary"):
-            st.session_state.archivos_procesados = None
-            st.session_state.comparacion_ejecutada = False
-            st.session_state.dataframes_procesados = None
-            st.session_state.info_archivos = None
-            st.session_state.revision_activa = None
+            reiniciar_sesion()
             st.rerun()
 
     else:
         st.error("⚠️ No se pudieron procesar suficientes archivos para realizar la comparación")
         if st.button("🔄 Volver a cargar archivos"):
-            st.session_state.archivos_procesados = None
-            st.session_state.comparacion_ejecutada = False
-            st.session_state.dataframes_procesados = None
-            st.session_state.info_archivos = None
-            st.session_state.revision_activa = None
+            reiniciar_sesion()
             st.rerun()